@@ -1,18 +1,31 @@
+import math
+import os
+import re
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
-from safetensors.torch import load_file
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from torch.nn.utils.rnn import pad_sequence
 from transformers import (
     ModernBertModel,
     ModernBertConfig,
 )
 from transformers.modeling_outputs import BaseModelOutput
-from transformers.models.t5.modeling_t5 import T5LayerNorm
-from typing import Iterator, Union, List, Generator, Tuple
+from transformers.utils import is_flash_attn_2_available
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Union, List, Generator, Tuple
 
 from nanoplm.models.student.tokenizer import ProtXTokenizer
 from nanoplm.models.student.feature_embedding import FeatureEmbedding
 
+# Matches the layer index in keys like "model.layers.0.attn.Wo.weight"
+_LAYER_INDEX_PATTERN = re.compile(r"model\.layers\.(\d+)\.")
+
+# Default padded-length multiple for a CUDA-graph compiled encoder
+_COMPILED_PAD_MULTIPLE = 64
+
 class ProtX(nn.Module):
     """Student model for ProtX"""
 
@@ -25,6 +38,7 @@ class ProtX(nn.Module):
         use_feature_embedding: bool = False,
         feature_window_size: int = 15,
         projection_layer: bool = True,
+        attn_implementation: str = "sdpa",
     ):
         super().__init__()
 
@@ -32,6 +46,10 @@ class ProtX(nn.Module):
         self.use_feature_embedding = use_feature_embedding
         self.feature_window_size = feature_window_size
         self.projection_layer = projection_layer
+        # Set by from_checkpoint when the encoder is wrapped in torch.compile
+        self.is_compiled = False
+        # Largest (batch_size, seq_len) the CUDA allocator has been warmed up with
+        self._warmup_shape = (0, 0)
 
         self.config = ModernBertConfig(
             vocab_size=self.tokenizer.vocab_size,
@@ -45,6 +63,7 @@ class ProtX(nn.Module):
             mlp_dropout=0.0,
             mlp_bias=False,
             attention_bias=False,
+            attn_implementation=attn_implementation,
         )
 
         self.model = ModernBertModel(self.config)
@@ -67,17 +86,29 @@ class ProtX(nn.Module):
         # Only add projection layer if requested
         if self.projection_layer:
             self.proj = nn.Linear(embed_dim, 1024, bias=False)
-            self.proj_norm = T5LayerNorm(1024)
+            self.proj_norm = FusedT5LayerNorm(1024)
 
     def forward(self, input_ids, attention_mask, training_mode = False, teacher_embeddings=None):
         if self.use_feature_embedding:
             # Generate embeddings using our custom feature embedding layer
             inputs_embeds = self.feature_embedding(input_ids, attention_mask)
             # Pass the generated embeddings directly to the model
-            student_out = self.model(inputs_embeds=inputs_embeds, attention_mask=attention_mask)
+            student_out = self.model(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                output_hidden_states=False,
+                output_attentions=False,
+                return_dict=True
+            )
         else:
             # Use standard ModernBERT forward pass with token IDs
-            student_out = self.model(input_ids=input_ids, attention_mask=attention_mask)
+            student_out = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                output_hidden_states=False,
+                output_attentions=False,
+                return_dict=True
+            )
         
         if training_mode:
             if self.projection_layer:
@@ -97,12 +128,9 @@ class ProtX(nn.Module):
                 attentions=student_out.attentions
             )
         else:
-            # Inference mode - always return raw embeddings without projection
-            return BaseModelOutput(
-                last_hidden_state=student_out.last_hidden_state,
-                hidden_states=student_out.hidden_states,
-                attentions=student_out.attentions
-            )
+            # Inference mode - always return raw embeddings without projection, as a plain
+            # (batch_size, seq_len, embed_dim) tensor with no output wrapper on the hot path
+            return student_out.last_hidden_state
 
     @staticmethod
     def load_and_generate_embeddings(
@@ -115,11 +143,17 @@ class ProtX(nn.Module):
         mlp_activation: str = "swiglu",
         use_feature_embedding: bool = False,
         feature_window_size: int = 3,
-        projection_layer: bool = True
+        projection_layer: bool = True,
+        compile_model: bool = True,
+        bucket_size_multiple: int = 16,
+        dtype: str = "bfloat16",
+        pad_to_multiple_of: Optional[int] = None,
+        quantize: bool = False
     ) -> Generator[Tuple[str, torch.Tensor], None, None]:
         """
         Load model from checkpoint and generate embeddings for sequences.
         Automatically detects model architecture from checkpoint.
+        To embed several inputs with one model, use from_checkpoint() and embed().
         
         Args:
             checkpoint_path: Path to the model.safetensors file
@@ -133,119 +167,389 @@ class ProtX(nn.Module):
             use_feature_embedding: If True, use enhanced feature embedding with hydropathy and charge
             feature_window_size: Window size for sliding window feature computation
             projection_layer: If True, include projection layer to 1024 dims (default: True)
+            compile_model: If True, compile the encoder with torch.compile on CUDA devices
+            bucket_size_multiple: Number of batches per length-sorted window; sequences are
+                                  sorted by length within each window to minimise padding
+            dtype: Inference precision on CUDA ("bfloat16", "float16" or "float32").
+                   Embeddings are always returned as float32
+            pad_to_multiple_of: Round each batch's padded length up to a multiple of this so
+                                only a few distinct shapes reach the compiled encoder.
+                                None rounds to a multiple of 64 only when the encoder is
+                                compiled; 0 disables rounding
+            quantize: If True, use dynamic int8 quantization for the encoder's linear layers (CPU only)
             
         Yields:
             Tuple of (sequence, embedding_tensor) for each input sequence
             - If per_seq_embeddings=True: embedding shape is [embed_dim]
             - If per_seq_embeddings=False: embedding shape is [sequence_length, embed_dim] 
         """
-        # Automatically detect model architecture from checkpoint
+        # Invalid arguments are the caller's error and propagate; only failures reading the
+        # checkpoint or its architecture are reported and end the generator
+        ProtX._resolve_inference_dtype(device, dtype, quantize)
         try:
-            embed_dim, num_layers, num_heads = ProtX.inspect_checkpoint_architecture(checkpoint_path)
-            print(f"Detected architecture: embed_dim={embed_dim}, num_layers={num_layers}, num_heads={num_heads}")
+            model = ProtX.from_checkpoint(
+                checkpoint_path,
+                device=device,
+                dtype=dtype,
+                mlp_activation=mlp_activation,
+                use_feature_embedding=use_feature_embedding,
+                feature_window_size=feature_window_size,
+                projection_layer=projection_layer,
+                compile_model=compile_model,
+                quantize=quantize
+            )
         except Exception as e:
-            print(f"Error detecting architecture: {e}")
+            print(f"Error loading checkpoint: {e}")
             return
         
-        # Create model instance with detected architecture
-        model = ProtX(
-            embed_dim=embed_dim,
-            num_layers=num_layers, 
-            num_heads=num_heads,
-            mlp_activation=mlp_activation,
-            use_feature_embedding=use_feature_embedding,
-            feature_window_size=feature_window_size,
-            projection_layer=projection_layer
+        yield from model.embed(
+            sequences,
+            batch_size=batch_size,
+            max_length=max_length,
+            per_seq_embeddings=per_seq_embeddings,
+            bucket_size_multiple=bucket_size_multiple,
+            pad_to_multiple_of=pad_to_multiple_of
         )
+    
+    @classmethod
+    def from_checkpoint(
+        cls,
+        checkpoint_path: str,
+        device: str = "cuda",
+        dtype: str = "bfloat16",
+        mlp_activation: str = "swiglu",
+        use_feature_embedding: bool = False,
+        feature_window_size: int = 3,
+        projection_layer: bool = True,
+        compile_model: bool = True,
+        quantize: bool = False
+    ) -> "ProtX":
+        """
+        Build a ProtX model from a safetensors checkpoint, ready for inference.
+        The architecture is detected from the checkpoint, which is read only once.
         
-        # Load the checkpoint
-        try:
-            state_dict = load_file(checkpoint_path)
-            
-            # Handle vocabulary size mismatch (e.g., pretrained model has mask token)
-            model_vocab_size = model.tokenizer.vocab_size
-            checkpoint_vocab_size = None
-            
-            # Find vocab size from checkpoint
-            for key, tensor in state_dict.items():
-                if 'embeddings.tok_embeddings.weight' in key:
-                    checkpoint_vocab_size = tensor.shape[0]
-                    break
+        Args:
+            checkpoint_path: Path to the model.safetensors file
+            device: Device to run inference on
+            dtype: Inference precision on CUDA ("bfloat16", "float16" or "float32")
+            mlp_activation: MLP activation function ("swiglu" or others)
+            use_feature_embedding: If True, use enhanced feature embedding with hydropathy and charge
+            feature_window_size: Window size for sliding window feature computation
+            projection_layer: If True, include projection layer to 1024 dims (default: True)
+            compile_model: If True, compile the encoder with torch.compile on CUDA devices.
+                           Compiled models use SDPA attention; FlashAttention-2 (when installed)
+                           is only used with compile_model=False, since its per-batch unpadded
+                           shapes would defeat CUDA graph replay
+            quantize: If True, use dynamic int8 quantization for the encoder's linear layers (CPU only)
             
-            if checkpoint_vocab_size and checkpoint_vocab_size != model_vocab_size:
-                print(f"Vocabulary size mismatch: checkpoint has {checkpoint_vocab_size}, model expects {model_vocab_size}")
-                print("Adjusting checkpoint to match model vocabulary...")
-                
-                # Handle embedding layer
-                for key in list(state_dict.keys()):
-                    if 'embeddings.tok_embeddings.weight' in key:
-                        # Take only the tokens that exist in the model's vocabulary
-                        state_dict[key] = state_dict[key][:model_vocab_size]
-                        print(f"Adjusted {key} from [{checkpoint_vocab_size}, {embed_dim}] to [{model_vocab_size}, {embed_dim}]")
+        Returns:
+            ProtX model on the requested device, in eval mode
             
-            model.load_state_dict(state_dict, strict=False)
-            print(f"Successfully loaded checkpoint from {checkpoint_path}")
-        except Exception as e:
-            print(f"Error loading checkpoint: {e}")
-            return
+        Raises:
+            ValueError: If dtype is unsupported, quantize is requested off-CPU,
+                        or the architecture cannot be determined
+            FileNotFoundError: If the checkpoint cannot be read
+            RuntimeError: If a checkpoint tensor has the wrong shape, or a parameter missing
+                          from the checkpoint cannot be initialised
+        """
+        torch_dtype = cls._resolve_inference_dtype(device, dtype, quantize)
+        use_autocast = str(device).startswith("cuda") and torch_dtype != torch.float32
+        
+        # Automatically detect model architecture from checkpoint tensor shapes
+        embed_dim, num_layers, num_heads = cls.inspect_checkpoint_architecture(checkpoint_path)
+        print(f"Detected architecture: embed_dim={embed_dim}, num_layers={num_layers}, num_heads={num_heads}")
+        
+        # Expandable segments let the caching allocator grow blocks in place rather than
+        # cudaMalloc-ing and fragmenting on the varying activation shapes of bucketed batches.
+        # An explicit PYTORCH_CUDA_ALLOC_CONF from the user takes precedence.
+        if str(device).startswith("cuda") and "PYTORCH_CUDA_ALLOC_CONF" not in os.environ:
+            torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+        
+        # FlashAttention-2 needs CUDA, half precision and the flash_attn package; otherwise
+        # SDPA still dispatches to its own flash/mem-efficient kernels where it can.
+        # FA2 unpads each batch to (total_nnz, D) with a .item() call, and total_nnz differs
+        # for almost every batch, so a reduce-overhead compiled encoder would record a new
+        # CUDA graph per batch; the compiled path keeps SDPA's padded, bucketable shapes.
+        will_compile = compile_model and str(device).startswith("cuda")
+        if use_autocast and not will_compile and is_flash_attn_2_available():
+            attn_implementation = "flash_attention_2"
+        else:
+            attn_implementation = "sdpa"
+        print(f"Using attention implementation: {attn_implementation}")
+        
+        # Create model instance with detected architecture. Parameters are created on the
+        # meta device, so no random init runs and no CPU copy of the weights is allocated;
+        # buffers (e.g. rotary inv_freq) are still computed for real.
+        with init_empty_weights():
+            model = cls(
+                embed_dim=embed_dim,
+                num_layers=num_layers, 
+                num_heads=num_heads,
+                mlp_activation=mlp_activation,
+                use_feature_embedding=use_feature_embedding,
+                feature_window_size=feature_window_size,
+                projection_layer=projection_layer,
+                attn_implementation=attn_implementation
+            )
         
-        # Move model to device and set to eval mode
+        # Stream weights tensor by tensor straight onto the device, so the full state dict
+        # is never held in host memory. Like load_state_dict(strict=False), keys missing
+        # from either side are skipped.
+        model_vocab_size = model.tokenizer.vocab_size
+        model_state = model.state_dict()
+        with safe_open(checkpoint_path, framework="pt", device=str(device)) as f:
+            for key in f.keys():
+                if key not in model_state:
+                    continue
+                
+                tensor_slice = f.get_slice(key)
+                checkpoint_shape = tuple(tensor_slice.get_shape())
+                if 'embeddings.tok_embeddings.weight' in key and checkpoint_shape[0] != model_vocab_size:
+                    # Handle vocabulary size mismatch (e.g., pretrained model has mask token):
+                    # read only the tokens that exist in the model's vocabulary
+                    print(f"Vocabulary size mismatch: checkpoint has {checkpoint_shape[0]}, model expects {model_vocab_size}")
+                    tensor = tensor_slice[:model_vocab_size]
+                    print(f"Adjusted {key} from [{checkpoint_shape[0]}, {embed_dim}] to [{model_vocab_size}, {embed_dim}]")
+                else:
+                    tensor = f.get_tensor(key)
+                
+                if tensor.shape != model_state[key].shape:
+                    raise RuntimeError(
+                        f"Size mismatch for {key}: checkpoint has {tuple(tensor.shape)}, "
+                        f"model expects {tuple(model_state[key].shape)}"
+                    )
+                set_module_tensor_to_device(
+                    model, key, device, value=tensor, dtype=torch_dtype if use_autocast else None
+                )
+        print(f"Successfully loaded checkpoint from {checkpoint_path}")
+        
+        # Parameters missing from the checkpoint (e.g. an unused projection head) are still
+        # on the meta device; allocate and initialise them as the eager constructor would.
+        # Without reset_parameters there is no way to initialise them, and running on the
+        # uninitialised storage from to_empty would silently produce garbage.
+        for name, module in model.named_modules():
+            if any(param.is_meta for param in module.parameters(recurse=False)):
+                if not hasattr(module, "reset_parameters"):
+                    raise RuntimeError(
+                        f"Parameters of '{name}' not found in checkpoint and cannot be initialised"
+                    )
+                module.to_empty(device=device, recurse=False)
+                module.reset_parameters()
+        
+        # Move remaining buffers to device and set to eval mode
         model.to(device)
         model.eval()
+        if use_autocast:
+            model.to(dtype=torch_dtype)
+        
+        # Store the encoder's linear weights as int8 and run them through int8 GEMMs
+        # (VNNI on x86). Embeddings and norms stay in float; the projection head is
+        # only used for distillation, so it is left untouched.
+        if quantize:
+            model.model = torch.ao.quantization.quantize_dynamic(model.model, {nn.Linear}, dtype=torch.qint8)
+        
+        # Compile the encoder to fuse attention/MLP ops and cut Python dispatch overhead.
+        # dynamic=True since each batch is padded to its own longest sequence.
+        # reduce-overhead captures a CUDA graph per input shape and replays it, so batches
+        # are padded to a multiple of pad_to_multiple_of to keep the number of graphs small.
+        # Compiling here lets the warmup be amortised across embed() calls.
+        if will_compile:
+            model.model = torch.compile(model.model, mode="reduce-overhead", fullgraph=False, dynamic=True)
+            model.is_compiled = True
+        
+        return model
+
+    @staticmethod
+    def _resolve_inference_dtype(device: str, dtype: str, quantize: bool) -> torch.dtype:
+        """
+        Validate the inference options and map dtype to its torch.dtype.
+        
+        Raises:
+            ValueError: If dtype is unsupported or quantize is requested off-CPU
+        """
+        # Run in reduced precision on CUDA: halves weight bytes and enables Tensor Core paths
+        dtypes = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+        if dtype not in dtypes:
+            raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(dtypes)}")
+        if quantize and str(device) != "cpu":
+            raise ValueError(f"Dynamic int8 quantization is only supported on CPU, got device '{device}'")
+        return dtypes[dtype]
+
+    def embed(
+        self,
+        sequences: Union[List[str], Iterator[str]],
+        batch_size: int = 32,
+        max_length: int = 512,
+        per_seq_embeddings: bool = True,  # True for pooled, False for per-token
+        bucket_size_multiple: int = 16,
+        pad_to_multiple_of: Optional[int] = None
+    ) -> Generator[Tuple[str, torch.Tensor], None, None]:
+        """
+        Generate embeddings for sequences with this model.
+        Runs on the device and in the precision the model's weights are in.
+        
+        Args:
+            sequences: Iterator or list of protein sequences
+            batch_size: Number of sequences to process at once
+            max_length: Maximum sequence length for tokenization
+            per_seq_embeddings: If True, return pooled sequence-level embeddings [embed_dim].
+                               If False, return per-token embeddings [sequence_length, embed_dim]
+            bucket_size_multiple: Number of batches per length-sorted window; sequences are
+                                  sorted by length within each window to minimise padding
+            pad_to_multiple_of: Round each batch's padded length up to a multiple of this so
+                                only a few distinct shapes reach the compiled encoder.
+                                None rounds to a multiple of 64 only when the encoder is
+                                compiled; 0 disables rounding
+            
+        Yields:
+            Tuple of (sequence, embedding_tensor) for each input sequence, as float32
+            - If per_seq_embeddings=True: embedding shape is [embed_dim]
+            - If per_seq_embeddings=False: embedding shape is [sequence_length, embed_dim] 
+        """
+        param = next(self.parameters())
+        device = param.device
+        torch_dtype = param.dtype
+        use_autocast = device.type == "cuda" and torch_dtype != torch.float32
+        # Rounding the padded length only pays off when CUDA graphs are replayed per shape;
+        # in eager mode it is just extra padded compute
+        if pad_to_multiple_of is None:
+            pad_to_multiple_of = _COMPILED_PAD_MULTIPLE if self.is_compiled else 0
         
         # Convert sequences to list if it's an iterator
         if not isinstance(sequences, list):
             sequences = list(sequences)
         
-        # Process sequences in batches
-        with torch.no_grad():
-            for i in range(0, len(sequences), batch_size):
-                batch_sequences = sequences[i:i + batch_size]
+        if device.type == "cuda" and sequences:
+            # Warm up with the largest batch shape seen so far, so the allocator reserves its
+            # peak once up front instead of growing mid-stream. Only a shape larger than any
+            # previous warmup triggers another forward, so repeated embed() calls skip it.
+            longest = min(max(len(seq) for seq in sequences) + 1, max_length)  # +1 for EOS
+            if pad_to_multiple_of:
+                longest = -(-longest // pad_to_multiple_of) * pad_to_multiple_of
+            warmup_shape = (min(batch_size, len(sequences)), longest)
+            if any(new > old for new, old in zip(warmup_shape, self._warmup_shape)):
+                warmup_shape = tuple(map(max, warmup_shape, self._warmup_shape))
+                warmup_ids = torch.zeros(warmup_shape, dtype=torch.long, device=device)
+                with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch_dtype, enabled=use_autocast):
+                    self.forward(input_ids=warmup_ids, attention_mask=torch.ones_like(warmup_ids), training_mode=False)
+                self._warmup_shape = warmup_shape
+        
+        # Sort each window of batch_size * bucket_size_multiple sequences by token length so
+        # that batches hold similar lengths and are padded to the bucket max instead of the
+        # longest outlier. Results are buffered per window and yielded in input order.
+        window_size = batch_size * max(1, bucket_size_multiple)
+        windows = [sequences[w:w + window_size] for w in range(0, len(sequences), window_size)]
+        pin_memory = device.type == "cuda"
+        pooled_host = None  # persistent pinned staging buffer for pooled embeddings
+        
+        def encode(window):
+            # Tokenize each sequence exactly once, unpadded; batches are padded in collate()
+            return self.tokenizer.batch_encode_plus(
+                window,
+                padding=False,
+                truncation=True,
+                max_length=max_length,
+                return_attention_mask=False
+            )["input_ids"]
+        
+        def collate(batch_ids):
+            lengths = torch.tensor([len(ids) for ids in batch_ids])
+            input_ids = pad_sequence(
+                [torch.tensor(ids, dtype=torch.long) for ids in batch_ids],
+                batch_first=True,
+                padding_value=self.tokenizer.pad_token_id
+            )
+            if pad_to_multiple_of:
+                padded_length = -(-input_ids.shape[1] // pad_to_multiple_of) * pad_to_multiple_of
+                input_ids = F.pad(input_ids, (0, padded_length - input_ids.shape[1]), value=self.tokenizer.pad_token_id)
+            attention_mask = (torch.arange(input_ids.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)).long()
+            # Page-locked host memory lets the H2D copy run asynchronously
+            if pin_memory:
+                input_ids = input_ids.pin_memory()
+                attention_mask = attention_mask.pin_memory()
+            return input_ids, attention_mask
+        
+        # Process sequences window by window, tokenizing window w + 1 on a worker thread
+        # while the device runs window w
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(encode, windows[0]) if windows else None
+            for w, window in enumerate(windows):
+                encoded = future.result()
+                if w + 1 < len(windows):
+                    future = executor.submit(encode, windows[w + 1])
                 
-                # Tokenize the batch
-                tokenized = model.tokenizer.batch_encode_plus(
-                    batch_sequences,
-                    padding=True,
-                    truncation=True,
-                    max_length=max_length,
-                    return_tensors="pt"
-                )
+                order = sorted(range(len(window)), key=lambda k: len(encoded[k]))
+                batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+                results = {}
+                packed_batches = []  # per-token outputs awaiting their D2H copy
                 
-                # Move to device
-                input_ids = tokenized["input_ids"].to(device)
-                attention_mask = tokenized["attention_mask"].to(device)
+                # inference_mode skips autograd version counting and view tracking. It is
+                # scoped to the compute so it doesn't leak into the caller between yields,
+                # and the host-side clones below produce ordinary (non-inference) tensors.
+                with torch.inference_mode():
+                    for b, batch_indices in enumerate(batches):
+                        input_ids, attention_mask = collate([encoded[k] for k in batch_indices])
+                        
+                        # Move to device, keeping the host mask for length bookkeeping
+                        attention_mask_host = attention_mask
+                        input_ids = input_ids.to(device, non_blocking=True)
+                        attention_mask = attention_mask.to(device, non_blocking=True)
+                    
+                        # Generate embeddings
+                        with torch.autocast(device_type="cuda", dtype=torch_dtype, enabled=use_autocast):
+                            embeddings = self.forward(
+                                input_ids=input_ids,
+                                attention_mask=attention_mask,
+                                training_mode=False
+                            )  # (batch_size, seq_len, embed_dim)
+                    
+                        if per_seq_embeddings:
+                            # Return pooled sequence-level embeddings (mean pooling)
+                            # Exclude the EOS token, which sits at the last unmasked position of each row
+                            eos_positions = (attention_mask.sum(dim=1, keepdim=True) - 1).clamp(min=0)
+                            mask_no_eos = attention_mask.scatter(1, eos_positions, 0)
+                            mean_pooled = masked_mean_pooling(embeddings, mask_no_eos)
+                        
+                            # Stage the whole batch with a single async D2H copy
+                            if pooled_host is None:
+                                pooled_host = torch.empty((window_size, mean_pooled.shape[-1]), pin_memory=pin_memory)
+                            start = b * batch_size
+                            pooled_host[start:start + len(batch_indices)].copy_(mean_pooled, non_blocking=pin_memory)
+                        else:
+                            # Return per-token embeddings (remove padding and EOS token). Lengths come
+                            # from the host mask, so no device sync is needed; the kept tokens are packed
+                            # with a single gather and copied to the host in one async transfer.
+                            lengths = attention_mask_host.sum(dim=1) - 1  # Subtract 1 for EOS token
+                            positions = torch.arange(attention_mask_host.shape[1])
+                            token_mask = positions.unsqueeze(0) < lengths.unsqueeze(1)  # (batch_size, seq_len)
+                            token_index = token_mask.flatten().nonzero().squeeze(1)
+                            if pin_memory:
+                                token_index = token_index.pin_memory()
+                            token_index = token_index.to(device, non_blocking=True)
+                        
+                            packed = embeddings.flatten(0, 1).index_select(0, token_index).float()
+                            packed_host = torch.empty(packed.shape, pin_memory=pin_memory)
+                            packed_host.copy_(packed, non_blocking=pin_memory)
+                            packed_batches.append((batch_indices, packed_host, lengths.tolist()))
                 
-                # Generate embeddings
-                outputs = model.forward(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    training_mode=False
-                )
+                # Wait once for all of the window's D2H copies
+                if pin_memory:
+                    torch.cuda.synchronize(device)
                 
-                # Extract embeddings based on per_seq_embeddings setting
-                embeddings = outputs.last_hidden_state  # (batch_size, seq_len, embed_dim)
+                for batch_indices, packed_host, lengths in packed_batches:
+                    # Clone out of pinned memory so yielded tensors don't hold page-locked pages
+                    for k, seq_embeddings in zip(batch_indices, packed_host.clone().split(lengths)):
+                        results[k] = seq_embeddings
                 
                 if per_seq_embeddings:
-                    # Return pooled sequence-level embeddings (mean pooling)
-                    # Exclude EOS token by removing the last position from embeddings and mask
-                    embeddings_no_eos = embeddings[:, :-1, :]  # Remove last token (EOS)
-                    mask_no_eos = attention_mask[:, :-1]  # Remove last position from mask
-                    
-                    mask_expanded = mask_no_eos.unsqueeze(-1).expand(embeddings_no_eos.size()).float()
-                    masked_embeddings = embeddings_no_eos * mask_expanded
-                    summed = torch.sum(masked_embeddings, dim=1)
-                    summed_mask = torch.clamp(mask_expanded.sum(dim=1), min=1e-9)
-                    mean_pooled = summed / summed_mask
-                    
-                    # Yield each sequence with its pooled embedding
-                    for j, (seq, embedding) in enumerate(zip(batch_sequences, mean_pooled)):
-                        yield seq, embedding.cpu()
-                else:
-                    # Return per-token embeddings (remove padding and EOS token)
-                    for j, (seq, seq_embeddings, seq_mask) in enumerate(zip(batch_sequences, embeddings, attention_mask)):
-                        # Get actual sequence length (excluding padding and EOS)
-                        actual_length = seq_mask.sum().item() - 1  # Subtract 1 for EOS token
-                        yield seq, seq_embeddings[:actual_length].cpu()
+                    # Move out of the reusable pinned buffer
+                    window_pooled = pooled_host[:len(order)].clone()
+                    for pos, k in enumerate(order):
+                        results[k] = window_pooled[pos]
+                
+                # Yield the window back in the caller's order
+                for k, seq in enumerate(window):
+                    yield seq, results[k]
     
     @staticmethod
     def inspect_checkpoint_architecture(checkpoint_path: str) -> Tuple[int, int, int]:
@@ -263,13 +567,24 @@ class ProtX(nn.Module):
             FileNotFoundError: If checkpoint file doesn't exist
         """
         try:
-            # Load the state dict
-            state_dict = load_file(checkpoint_path)
+            # Only the safetensors header is parsed; no tensor data is read
+            with safe_open(checkpoint_path, framework="pt") as f:
+                shapes = {key: tuple(f.get_slice(key).get_shape()) for key in f.keys()}
         except Exception as e:
             raise FileNotFoundError(f"Error loading checkpoint from {checkpoint_path}: {e}")
         
+        return ProtX._infer_arch_from_shapes(shapes)
+
+    @staticmethod
+    def _infer_arch_from_shapes(shapes: Dict[str, Tuple[int, ...]]) -> Tuple[int, int, int]:
+        """
+        Infer (embed_dim, num_layers, num_heads) from the parameter shapes of a checkpoint.
+        
+        Raises:
+            ValueError: If architecture cannot be determined from the shapes
+        """
         # Calculate total number of parameters
-        total_params = sum(tensor.numel() for tensor in state_dict.values())
+        total_params = sum(math.prod(shape) for shape in shapes.values())
         print(f"Total number of parameters: {total_params:,}")
         
         # Extract architecture information from parameter shapes
@@ -278,44 +593,32 @@ class ProtX(nn.Module):
         num_heads = None
         
         # Find embed_dim from various possible parameters
-        for key, tensor in state_dict.items():
+        for key, shape in shapes.items():
             if 'embeddings.tok_embeddings.weight' in key:
-                vocab_size, embed_dim = tensor.shape
+                vocab_size, embed_dim = shape
                 break
             elif 'model.layers.0.attn.Wo.weight' in key:
-                embed_dim, _ = tensor.shape
+                embed_dim, _ = shape
                 break
             elif 'model.layers.0.mlp.Wi.weight' in key:
-                _, embed_dim = tensor.shape
+                _, embed_dim = shape
                 break
         
         if embed_dim is None:
             raise ValueError("Could not determine embed_dim from checkpoint")
         
         # Count number of layers by looking for layer-specific parameters
-        layer_indices = set()
-        for key in state_dict.keys():
-            if 'model.layers.' in key:
-                # Extract layer number from key like "model.layers.0.attn.Wo.weight"
-                parts = key.split('.')
-                for i, part in enumerate(parts):
-                    if part == 'layers' and i + 1 < len(parts):
-                        try:
-                            layer_idx = int(parts[i + 1])
-                            layer_indices.add(layer_idx)
-                        except ValueError:
-                            continue
-        
+        layer_indices = {int(match.group(1)) for match in map(_LAYER_INDEX_PATTERN.search, shapes) if match}
         num_layers = len(layer_indices)
         
         if num_layers == 0:
             raise ValueError("Could not determine num_layers from checkpoint")
         
         # Find number of attention heads from Wqkv matrix
-        for key, tensor in state_dict.items():
+        for key, shape in shapes.items():
             if 'model.layers.0.attn.Wqkv.weight' in key:
                 # Wqkv weight shape is [3 * embed_dim, embed_dim] for combined Q,K,V
-                qkv_dim, model_dim = tensor.shape
+                qkv_dim, model_dim = shape
                 
                 if qkv_dim == 3 * embed_dim:
                     # Standard multi-head attention patterns
@@ -335,11 +638,11 @@ class ProtX(nn.Module):
         
         # Alternative: look for separate Q,K,V or other attention patterns
         if num_heads is None:
-            for key, tensor in state_dict.items():
+            for key, shape in shapes.items():
                 if 'query' in key.lower() and 'weight' in key and 'layers.0' in key:
                     # If we find separate query weights, analyze them
-                    if len(tensor.shape) == 2:
-                        out_dim, in_dim = tensor.shape
+                    if len(shape) == 2:
+                        out_dim, in_dim = shape
                         if in_dim == embed_dim:
                             # num_heads = out_dim / head_dim, try standard head dimensions
                             for head_dim in [32, 64, 128]:
@@ -508,8 +811,62 @@ class ProtX(nn.Module):
         print(f"  Output projection: {output_params:,} ({output_params/total_params*100:.1f}%)")
 
 
+def masked_mean_pooling(embeddings: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Mean-pool token embeddings over the positions selected by attention_mask.
+    
+    The mean is a single batched matmul, (B, 1, S) @ (B, S, D), with the mask pre-scaled by
+    1 / token count, instead of separate expand/mul/sum kernels that each re-read the
+    (B, S, D) tensor. The matmul runs in the hidden-state dtype, so no upcast copy of the
+    hidden states is made: for bf16 inputs the GEMM accumulates in fp32 and only the
+    (B, D) mean is rounded to bf16, the precision the hidden states already have.
+    
+    Args:
+        embeddings: [batch_size, seq_len, embed_dim] token embeddings
+        attention_mask: [batch_size, seq_len] mask of positions to average over
+        
+    Returns:
+        [batch_size, embed_dim] float32 pooled embeddings
+    """
+    # Only the small (B, 1, S) weights are built; neither a (B, S, D) mask nor an fp32 copy
+    # of the hidden states is materialised
+    mask = attention_mask.unsqueeze(1).float()  # (B, 1, S)
+    weights = (mask / mask.sum(dim=-1, keepdim=True).clamp(min=1e-9)).to(embeddings.dtype)
+    # Autocast is disabled so the matmul stays in the hidden-state dtype
+    with torch.autocast(device_type=embeddings.device.type, enabled=False):
+        mean = torch.bmm(weights, embeddings).squeeze(1)  # (B, D)
+    return mean.float()
+
+
+class FusedT5LayerNorm(nn.Module):
+    """
+    T5-style RMSNorm (scale only, no mean subtraction or bias) computed by the single
+    F.rms_norm kernel rather than separate variance, rsqrt and scale ops.
+    Parameter names match T5LayerNorm, so existing checkpoints load unchanged.
+    """
+
+    def __init__(self, hidden_size: int, eps: float = 1e-6):
+        super().__init__()
+        self.weight = nn.Parameter(torch.ones(hidden_size))
+        self.eps = eps
+
+    def reset_parameters(self):
+        nn.init.ones_(self.weight)
+
+    def forward(self, hidden_states):
+        # Match T5LayerNorm's dtypes: normalise in fp32 for an fp32 weight (e.g. bf16 AMP
+        # activations) and return half for a half weight. Casting to the weight dtype also
+        # keeps input and weight dtypes equal, which the fused kernel requires.
+        hidden_states = hidden_states.to(self.weight.dtype)
+        return F.rms_norm(hidden_states, (hidden_states.shape[-1],), self.weight, self.eps)
+
+
 class SwiGLU(nn.Module):
     def forward(self, x, gate):
+        if not torch.is_grad_enabled():
+            # Inference: gate is a view into the fresh Wi output, so apply silu and the
+            # product in place instead of allocating two more intermediate-sized tensors
+            return F.silu(gate, inplace=True).mul_(x)
         return F.silu(gate) * x
 
 
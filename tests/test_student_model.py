@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Tests for loading ProtX student checkpoints and generating embeddings.
+"""
+
+import random
+import warnings
+
+import pytest
+import torch
+from safetensors.torch import save_file
+from transformers.models.t5.modeling_t5 import T5LayerNorm
+
+from nanoplm.models.student import ProtX
+from nanoplm.models.student.model import FusedT5LayerNorm, masked_mean_pooling
+
+
+def save_student_checkpoint(tmp_path):
+    """Save a small randomly initialised ProtX to a safetensors file."""
+    torch.manual_seed(0)
+    model = ProtX(embed_dim=128, num_layers=2, num_heads=2)
+    model.eval()
+    checkpoint_path = tmp_path / "model.safetensors"
+    save_file({k: v.contiguous() for k, v in model.state_dict().items()}, str(checkpoint_path))
+    return model, str(checkpoint_path)
+
+
+def make_protein_sequences():
+    """Sequences of varied lengths so batches need padding and length sorting matters."""
+    rng = random.Random(0)
+    amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+    return ["".join(rng.choice(amino_acids) for _ in range(rng.randint(3, 90))) for _ in range(21)]
+
+
+def reference_embedding(model, sequence, per_seq_embeddings):
+    """Embed a single sequence without batching or padding, excluding the EOS token."""
+    with torch.no_grad():
+        tokenized = model.tokenizer([sequence], return_tensors="pt")
+        hidden = model(tokenized["input_ids"], tokenized["attention_mask"])[0, :-1]
+    return hidden.mean(dim=0) if per_seq_embeddings else hidden
+
+
+class TestCheckpointLoading:
+    """Test suite for inspecting and loading ProtX checkpoints."""
+
+    @pytest.fixture
+    def student_checkpoint(self, tmp_path):
+        """Create a small ProtX model and its safetensors checkpoint."""
+        return save_student_checkpoint(tmp_path)
+
+    @pytest.fixture
+    def protein_sequences(self):
+        """Create protein sequences of varied lengths."""
+        return make_protein_sequences()
+
+    def test_inspect_checkpoint_architecture(self, student_checkpoint):
+        """Architecture is recovered from the checkpoint's tensor shapes"""
+        _, checkpoint_path = student_checkpoint
+        assert ProtX.inspect_checkpoint_architecture(checkpoint_path) == (128, 2, 2)
+
+    def test_inspect_checkpoint_architecture_missing_file(self, tmp_path):
+        """A missing checkpoint raises FileNotFoundError"""
+        with pytest.raises(FileNotFoundError):
+            ProtX.inspect_checkpoint_architecture(str(tmp_path / "missing.safetensors"))
+
+    def test_from_checkpoint_initialises_missing_parameters(self, student_checkpoint, tmp_path, monkeypatch):
+        """Parameters missing from the checkpoint are initialised, or loading fails"""
+        model, _ = student_checkpoint
+        checkpoint_path = str(tmp_path / "no_proj_norm.safetensors")
+        save_file({k: v.contiguous() for k, v in model.state_dict().items() if not k.startswith("proj_norm.")}, checkpoint_path)
+
+        # Initialised with reset_parameters, like the eager constructor
+        loaded = ProtX.from_checkpoint(checkpoint_path, device="cpu", dtype="float32")
+        assert torch.equal(loaded.proj_norm.weight, torch.ones(1024))
+
+        # Without reset_parameters the parameters must not be left uninitialised
+        monkeypatch.delattr(FusedT5LayerNorm, "reset_parameters")
+        with pytest.raises(RuntimeError):
+            ProtX.from_checkpoint(checkpoint_path, device="cpu", dtype="float32")
+
+    def test_from_checkpoint_quantized_embeddings_close(self, student_checkpoint, protein_sequences):
+        """Dynamic int8 quantization on CPU stays close to the float model"""
+        model, checkpoint_path = student_checkpoint
+        quantized = ProtX.from_checkpoint(checkpoint_path, device="cpu", quantize=True)
+
+        for seq, embedding in quantized.embed(protein_sequences[:5], batch_size=2):
+            expected = reference_embedding(model, seq, per_seq_embeddings=True)
+            assert torch.allclose(embedding, expected, atol=5e-2)
+
+    def test_from_checkpoint_quantize_requires_cpu(self, student_checkpoint):
+        """Quantization is rejected for non-CPU devices"""
+        _, checkpoint_path = student_checkpoint
+        with pytest.raises(ValueError):
+            ProtX.from_checkpoint(checkpoint_path, device="cuda", quantize=True)
+
+    @pytest.mark.parametrize("options", [{"dtype": "float64"}, {"device": "cuda", "quantize": True}])
+    def test_load_and_generate_embeddings_raises_on_invalid_options(self, student_checkpoint, protein_sequences, options):
+        """Invalid arguments raise instead of being reported as a checkpoint loading error"""
+        _, checkpoint_path = student_checkpoint
+        kwargs = {"device": "cpu", "compile_model": False, **options}
+        with pytest.raises(ValueError):
+            list(ProtX.load_and_generate_embeddings(checkpoint_path, protein_sequences, **kwargs))
+
+
+class TestEmbed:
+    """Test suite for generating embeddings from a loaded ProtX model."""
+
+    @pytest.fixture
+    def student_checkpoint(self, tmp_path):
+        """Create a small ProtX model and its safetensors checkpoint."""
+        return save_student_checkpoint(tmp_path)
+
+    @pytest.fixture
+    def protein_sequences(self):
+        """Create protein sequences of varied lengths."""
+        return make_protein_sequences()
+
+    @pytest.mark.parametrize("per_seq_embeddings", [True, False])
+    def test_load_and_generate_embeddings_matches_unbatched(self, student_checkpoint, protein_sequences, per_seq_embeddings):
+        """Batched, length-sorted embeddings match unbatched ones and keep input order"""
+        model, checkpoint_path = student_checkpoint
+
+        results = list(ProtX.load_and_generate_embeddings(
+            checkpoint_path,
+            protein_sequences,
+            batch_size=4,
+            device="cpu",
+            per_seq_embeddings=per_seq_embeddings,
+            compile_model=False,
+            bucket_size_multiple=2,
+        ))
+
+        assert [seq for seq, _ in results] == protein_sequences
+        for seq, embedding in results:
+            expected = reference_embedding(model, seq, per_seq_embeddings)
+            assert embedding.dtype == torch.float32
+            assert embedding.shape == expected.shape
+            assert torch.allclose(embedding, expected, atol=1e-4)
+
+    def test_embed_does_not_leak_inference_mode(self, student_checkpoint, protein_sequences):
+        """Grad mode is untouched between yields and yielded tensors are ordinary tensors"""
+        _, checkpoint_path = student_checkpoint
+        model = ProtX.from_checkpoint(checkpoint_path, device="cpu", dtype="float32")
+
+        for per_seq_embeddings in (True, False):
+            for _, embedding in model.embed(protein_sequences, batch_size=4, per_seq_embeddings=per_seq_embeddings):
+                assert torch.is_grad_enabled()
+                assert not torch.is_inference_mode_enabled()
+                assert not embedding.is_inference()
+                embedding.mul_(1.0)  # in-place ops must work on yielded tensors
+
+    def test_embed_pads_to_batch_max_when_not_compiled(self, student_checkpoint, protein_sequences):
+        """Without a compiled encoder, batches are padded only to their longest sequence"""
+        _, checkpoint_path = student_checkpoint
+        model = ProtX.from_checkpoint(checkpoint_path, device="cpu", dtype="float32")
+        assert not model.is_compiled
+
+        padded_lengths = []
+        model.model.register_forward_pre_hook(lambda module, args, kwargs: padded_lengths.append(
+            (kwargs["input_ids"].shape[1], int(kwargs["attention_mask"].sum(dim=1).max()))
+        ), with_kwargs=True)
+        list(model.embed(protein_sequences, batch_size=4))
+
+        assert padded_lengths
+        assert all(padded == longest for padded, longest in padded_lengths)
+
+
+class TestKernels:
+    """Test suite for the fused pooling and normalisation building blocks."""
+
+    def test_masked_mean_pooling_matches_fp32_reference(self):
+        """bf16 hidden states pool to a float32 mean within bf16 precision of an fp32 reduction"""
+        torch.manual_seed(0)
+        embeddings = (torch.randn(3, 50, 16) * 10 + 100).bfloat16()
+        attention_mask = (torch.rand(3, 50) > 0.3).long()
+        expected = (embeddings.float() * attention_mask.unsqueeze(-1)).sum(dim=1) / attention_mask.sum(dim=1, keepdim=True)
+
+        pooled = masked_mean_pooling(embeddings, attention_mask)
+        assert pooled.dtype == torch.float32
+        # Only the (B, D) mean is rounded to bf16, i.e. within a couple of bf16 ulps (2^-8)
+        assert torch.allclose(pooled, expected, rtol=1e-2, atol=0)
+
+    def test_fused_t5_layer_norm_matches_t5_layer_norm(self):
+        """FusedT5LayerNorm is a drop-in replacement for T5LayerNorm, state dict included"""
+        torch.manual_seed(0)
+        reference = T5LayerNorm(64)
+        torch.nn.init.normal_(reference.weight)
+        fused = FusedT5LayerNorm(64)
+        fused.load_state_dict(reference.state_dict())
+
+        hidden_states = torch.randn(2, 7, 64)
+        assert torch.allclose(fused(hidden_states), reference(hidden_states), atol=1e-5)
+
+        # Mixed precision: bf16 activations with an fp32 weight are normalised and returned in fp32
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            fused_out = fused(hidden_states.bfloat16())
+        reference_out = reference(hidden_states.bfloat16())
+        assert fused_out.dtype == reference_out.dtype == torch.float32
+        assert torch.allclose(fused_out, reference_out, atol=1e-5)